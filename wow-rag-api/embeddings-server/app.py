@@ -1,54 +1,341 @@
-from flask import Flask, request, jsonify
+import os
+import psutil
+
+# Each uvicorn worker gets a disjoint share of the physical cores unless
+# OMP_NUM_THREADS is set explicitly. Must be set before torch / onnxruntime are
+# imported to avoid thread oversubscription
+WORKERS = int(os.getenv('WORKERS', 1))
+os.environ.setdefault('OMP_NUM_THREADS', str(max(1, (psutil.cpu_count(logical=False) or os.cpu_count()) // WORKERS)))
+THREADS_PER_WORKER = int(os.environ['OMP_NUM_THREADS'])
+
+import asyncio
+import atexit
+import fcntl
+import json
+import math
+import shutil
+import threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+import numpy as np
+import onnxruntime as ort
+import orjson
+import torch
 import logging
-import os
 
-app = Flask(__name__)
+torch.set_num_threads(THREADS_PER_WORKER)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global model variable
+# Micro-batching settings: requests arriving within MAX_WAIT_MS of each other
+# are coalesced into a single model.encode call (up to MAX_BATCH requests)
+MAX_BATCH = int(os.getenv('MAX_BATCH', 32))
+MAX_WAIT_MS = float(os.getenv('MAX_WAIT_MS', 5))
+ENCODE_BATCH_SIZE = int(os.getenv('ENCODE_BATCH_SIZE', 64))
+
+# 'onnx' runs an int8-quantized ONNX export on CPU, 'torch' uses SentenceTransformer.
+# 'auto' picks torch on CUDA and onnx otherwise
+EMBEDDINGS_BACKEND = os.getenv('EMBEDDINGS_BACKEND', 'auto')
+ONNX_CACHE_DIR = os.getenv('ONNX_CACHE_DIR', '/root/.cache/torch/sentence_transformers/onnx')
+# Overrides the model's own max_seq_length on the ONNX backend when set
+MAX_SEQ_LENGTH = int(os.getenv('MAX_SEQ_LENGTH', 0)) or None
+
+# Global model variable, loaded once per worker in lifespan
 model = None
+_load_lock = threading.Lock()
+
+# Multi-GPU process pool for SentenceTransformer.encode_multi_process (one process per GPU)
+pool = None
+
+# Pending (texts, future) pairs waiting to be encoded
+queue = None
+
+class UnsupportedOnnxModel(ValueError):
+    """The model's sentence-transformers pipeline can't be reproduced by OnnxEncoder"""
+
+class OnnxEncoder:
+    """Encoder backed by an int8 ONNX Runtime session.
+
+    Pooling, normalization and max_seq_length are read from the model's
+    sentence-transformers config, so the output matches the PyTorch model up to
+    int8 quantization error. Models with other modules (e.g. Dense) or pooling
+    modes raise UnsupportedOnnxModel.
+    """
+
+    def __init__(self, model_name):
+        # Short names such as 'all-MiniLM-L6-v2' live under the sentence-transformers org
+        repo_id = model_name if '/' in model_name else f"sentence-transformers/{model_name}"
+        export_dir = os.path.join(ONNX_CACHE_DIR, repo_id.replace('/', '__'))
+        model_path = os.path.join(export_dir, 'model_quantized.onnx')
+
+        # Workers start together: the first to take the lock exports, the others
+        # wait for it and re-check, so export_dir is never written concurrently
+        os.makedirs(ONNX_CACHE_DIR, exist_ok=True)
+        with open(f"{export_dir}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(model_path):
+                self._export(repo_id, export_dir)
+
+            # Plain transformers checkpoints have no modules.json; SentenceTransformer
+            # wraps those with mean pooling and no normalization
+            modules = self._st_config(repo_id, export_dir, 'modules.json') or []
+            pooling_path = next((m['path'] for m in modules if m['type'].endswith('Pooling')), None)
+            pooling_config = self._st_config(repo_id, export_dir, f"{pooling_path}/config.json") if pooling_path else None
+            st_config = self._st_config(repo_id, export_dir, 'sentence_bert_config.json') or {}
+
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+
+        unsupported = [m['type'] for m in modules if m['type'].rsplit('.', 1)[-1] not in ('Transformer', 'Pooling', 'Normalize')]
+        if unsupported:
+            raise UnsupportedOnnxModel(f"Unsupported sentence-transformers modules for ONNX: {unsupported}")
+        self.normalize = any(m['type'].endswith('Normalize') for m in modules)
+
+        self.pooling = 'mean'
+        if pooling_config:
+            modes = [mode for mode in ('cls_token', 'mean_tokens', 'max_tokens') if pooling_config.get(f"pooling_mode_{mode}")]
+            other = [key for key, value in pooling_config.items()
+                     if key.startswith('pooling_mode_') and value and key[len('pooling_mode_'):] not in modes]
+            if len(modes) != 1 or other:
+                raise UnsupportedOnnxModel(f"Unsupported pooling config for ONNX: {pooling_config}")
+            self.pooling = modes[0].split('_')[0]
+
+        self.max_seq_length = (
+            MAX_SEQ_LENGTH
+            or st_config.get('max_seq_length')
+            or min(self.tokenizer.model_max_length, 512)
+        )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = THREADS_PER_WORKER
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    @staticmethod
+    def _st_config(repo_id, export_dir, filename):
+        """Load a sentence-transformers config file, kept alongside the export; None if the repo has none"""
+        path = os.path.join(export_dir, filename)
+        if not os.path.exists(path):
+            try:
+                downloaded = hf_hub_download(repo_id, filename)
+            except EntryNotFoundError:
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(downloaded, path)
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _export(repo_id, export_dir):
+        """Export the model to ONNX once and quantize its weights to int8 (dynamic, VNNI)"""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+        logger.info(f"Exporting {repo_id} to ONNX in {export_dir}")
+        ort_model = ORTModelForFeatureExtraction.from_pretrained(repo_id, export=True)
+        ort_model.save_pretrained(export_dir)
+        AutoTokenizer.from_pretrained(repo_id).save_pretrained(export_dir)
+
+        quantizer = ORTQuantizer.from_pretrained(ort_model)
+        quantizer.quantize(
+            save_dir=export_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        )
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True):
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        # Tokenize once, then sort by token length so each batch is padded only
+        # to its own max length; the original order is restored at the end
+        encodings = self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)
+        order = np.argsort([len(ids) for ids in encodings['input_ids']], kind='stable')
+
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            indices = order[start:start + batch_size]
+            inputs = self.tokenizer.pad(
+                {name: [values[i] for i in indices] for name, values in encodings.items()},
+                padding=True,
+                return_tensors='np'
+            )
+            feeds = {name: value.astype(np.int64) for name, value in inputs.items() if name in self.input_names}
+            token_embeddings = self.session.run(None, feeds)[0]
+
+            # Pooling over non-padding tokens as configured by the model
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            if self.pooling == 'cls':
+                pooled = token_embeddings[:, 0]
+            elif self.pooling == 'max':
+                pooled = np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+            else:
+                pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled)
+
+        return np.concatenate(batches)[np.argsort(order)]
 
 def load_model():
-    global model
-    if model is None:
+    global model, pool
+    with _load_lock:
+        if model is not None:
+            return
+
         model_name = os.getenv('MODEL_NAME', 'all-MiniLM-L6-v2')
-        logger.info(f"Loading model: {model_name}")
-        model = SentenceTransformer(model_name)
+        backend = EMBEDDINGS_BACKEND
+        if backend == 'auto':
+            backend = 'torch' if torch.cuda.is_available() else 'onnx'
+
+        logger.info(f"Loading model: {model_name} (backend: {backend})")
+        if backend == 'onnx':
+            try:
+                model = OnnxEncoder(model_name)
+            except UnsupportedOnnxModel as e:
+                # 'auto' only picks ONNX for models whose pipeline it reproduces
+                if EMBEDDINGS_BACKEND != 'auto':
+                    raise
+                logger.warning(f"{e}; falling back to the torch backend")
+                backend = 'torch'
+        if backend != 'onnx':
+            model = SentenceTransformer(model_name)
+            if torch.cuda.is_available():
+                # FP16 weights: half the bytes streamed per forward on the GPU
+                model = model.to('cuda').half()
+
+            device_count = torch.cuda.device_count()
+            if device_count > 1:
+                logger.info(f"Starting encode pool on {device_count} GPUs")
+                pool = model.start_multi_process_pool(target_devices=[f"cuda:{i}" for i in range(device_count)])
+                atexit.register(model.stop_multi_process_pool, pool)
+                # Starting the pool moves the parent's weights to CPU to share them with
+                # the workers; small requests still encode here, so put them back on GPU
+                model = model.to('cuda').half()
         logger.info("Model loaded successfully")
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({"status": "healthy", "model_loaded": model is not None})
+def encode(texts):
+    # Both backends sort each call by length internally, so batches are padded
+    # only to their own max length
+    if pool is not None and len(texts) > ENCODE_BATCH_SIZE:
+        # Large batches (document ingestion) fan out across all GPUs
+        workers = len(pool['processes'])
+        embeddings = model.encode_multi_process(
+            texts,
+            pool,
+            batch_size=ENCODE_BATCH_SIZE,
+            chunk_size=math.ceil(len(texts) / workers)
+        )
+    else:
+        # inference_mode: no autograd bookkeeping on the forward pass
+        with torch.inference_mode():
+            embeddings = model.encode(texts, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True)
+    return embeddings
+
+async def batch_worker():
+    """Drain the queue into batches and scatter the embeddings back to each request"""
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(items) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        all_texts = [text for texts, _ in items for text in texts]
+        try:
+            # Encode in a worker thread so the event loop keeps accepting requests
+            embeddings = await asyncio.to_thread(encode, all_texts)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            continue
 
-@app.route('/embed', methods=['POST'])
-def embed():
+        offset = 0
+        for texts, future in items:
+            if not future.done():
+                future.set_result(embeddings[offset:offset + len(texts)])
+            offset += len(texts)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global queue
+    # Runs once per worker process, so each worker loads its own model copy
+    load_model()
+    queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker())
+    yield
+    worker.cancel()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.get('/health')
+async def health_check():
+    return {"status": "healthy", "model_loaded": model is not None}
+
+@app.post('/embed')
+async def embed(request: Request):
     try:
-        data = request.get_json()
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
         if not data or 'texts' not in data:
-            return jsonify({"error": "Missing 'texts' field"}), 400
-        
+            return JSONResponse({"error": "Missing 'texts' field"}, status_code=400)
+
         texts = data['texts']
-        if not isinstance(texts, list):
-            return jsonify({"error": "'texts' must be a list"}), 400
-        
-        # Load model if not already loaded
-        load_model()
-        
-        # Generate embeddings
-        embeddings = model.encode(texts)
-        
-        return jsonify({
-            "embeddings": embeddings.tolist(),
-            "model": os.getenv('MODEL_NAME', 'all-MiniLM-L6-v2')
-        })
-        
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return JSONResponse({"error": "'texts' must be a list of strings"}, status_code=400)
+
+        if not texts:
+            embeddings = np.empty((0, 0), dtype=np.float32)
+        else:
+            # Hand the texts to the batch worker and wait for our slice
+            future = asyncio.get_running_loop().create_future()
+            await queue.put((texts, future))
+            embeddings = await future
+
+        model_name = os.getenv('MODEL_NAME', 'all-MiniLM-L6-v2')
+
+        # Binary response: raw row-major float16 bytes, no per-float serialization
+        if 'application/octet-stream' in request.headers.get('accept', ''):
+            embeddings = embeddings.astype(np.float16)
+            return Response(
+                embeddings.tobytes(),
+                media_type='application/octet-stream',
+                headers={
+                    "X-Shape": f"{embeddings.shape[0]},{embeddings.shape[1]}",
+                    "X-Dtype": "float16",
+                    "X-Model": model_name
+                }
+            )
+
+        # orjson writes the float32 buffer directly, no Python float per value
+        return Response(
+            orjson.dumps(
+                {"embeddings": np.ascontiguousarray(embeddings, dtype=np.float32), "model": model_name},
+                option=orjson.OPT_SERIALIZE_NUMPY
+            ),
+            media_type='application/json'
+        )
+
     except Exception as e:
         logger.error(f"Error generating embeddings: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return JSONResponse({"error": str(e)}, status_code=500)
 
 if __name__ == '__main__':
+    import uvicorn
     port = int(os.getenv('PORT', 8000))
-    logger.info(f"Starting embeddings server on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    logger.info(f"Starting embeddings server on port {port} with {WORKERS} worker(s)")
+    uvicorn.run('app:app', host='0.0.0.0', port=port, workers=WORKERS, loop='uvloop', http='httptools')
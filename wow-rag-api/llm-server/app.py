@@ -1,62 +1,178 @@
 import os
+import asyncio
+import copy
+import functools
+import hashlib
 import json
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from uuid import uuid4
+from threading import Event, Lock
 from contextlib import asynccontextmanager
+import anyio
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    Cache,
+    StaticCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer
+)
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# "transformers" (default) or "vllm" (continuous batching, CUDA only)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "transformers")
+
+# bitsandbytes weight quantization on CUDA: "4bit" (default), "8bit" or "none"
+LLM_QUANTIZATION = os.getenv("LLM_QUANTIZATION", "4bit")
+
+# Maximum prompt + completion length held by the KV cache
+MAX_CACHE_LEN = int(os.getenv("MAX_CACHE_LEN", 4096))
+
+# Number of prefilled conversation prefixes (system prompt + history) kept for reuse
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", 4))
+
 # Global variables for model
 model = None
 tokenizer = None
-pipe = None
+generation_config = None
+static_cache = None
+prefix_cache = None
+engine = None
+
+# Every model forward (warm-up included) runs on this one thread: reduce-overhead
+# CUDA graphs are recorded per thread, so generations on other threads would not
+# reuse the graph captured at warm-up
+gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+
+# One generation at a time on the shared model / KV cache, waiting requests
+# queue here instead of holding threads
+gpu_sem = asyncio.Semaphore(1)
+
+async def run_on_gpu(fn, *args, **kwargs):
+    """Run fn on the GPU thread without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(gpu_executor, functools.partial(fn, *args, **kwargs))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load the DeepSeek model on startup"""
-    global model, tokenizer, pipe
+    global model, tokenizer, generation_config, static_cache, prefix_cache, engine
     
     try:
         model_name = os.getenv("MODEL_NAME", "microsoft/DialoGPT-medium")
         device = "cuda" if torch.cuda.is_available() else "cpu"
         
-        logger.info(f"Loading model: {model_name} on device: {device}")
+        # BF16 where the GPU supports it (Ampere+): FP32 exponent range, no
+        # attention overflow on long contexts, same bandwidth as FP16
+        if device == "cuda" and torch.cuda.is_bf16_supported():
+            dtype = torch.bfloat16
+            torch.backends.cuda.matmul.allow_bf16_reduced_precision_reduction = True
+        elif device == "cuda":
+            dtype = torch.float16
+        else:
+            dtype = torch.float32
+        
+        logger.info(f"Loading model: {model_name} on device: {device} ({dtype})")
         
-        # Load tokenizer
+        # Load tokenizer (prompts are built as token ids with its chat template)
         tokenizer = AutoTokenizer.from_pretrained(
             model_name,
             trust_remote_code=True,
+            use_fast=True,
             cache_dir="/root/.cache/huggingface"
         )
+        if tokenizer.chat_template is None:
+            tokenizer.chat_template = select_chat_template(model_name)
         
-        # Load model with memory optimizations
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            trust_remote_code=True,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-            device_map="auto" if device == "cuda" else None,
-            cache_dir="/root/.cache/huggingface",
-            low_cpu_mem_usage=True,
-            use_safetensors=True
-        )
+        if LLM_BACKEND == "vllm":
+            # Continuous batching + paged KV cache; shared prompt prefixes (system
+            # prompt, retrieved context) are prefilled once and reused
+            from vllm import AsyncEngineArgs, AsyncLLMEngine
+            
+            engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+                model=model_name,
+                trust_remote_code=True,
+                download_dir="/root/.cache/huggingface",
+                dtype=str(dtype).replace("torch.", ""),
+                enable_prefix_caching=True,
+                gpu_memory_utilization=0.9,
+                max_model_len=MAX_CACHE_LEN
+            ))
+        else:
+            # Quantized weights cut the bytes read per decode step (bitsandbytes is CUDA only)
+            quantization_config = None
+            if device == "cuda" and LLM_QUANTIZATION == "4bit":
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=dtype,
+                    bnb_4bit_use_double_quant=True
+                )
+            elif device == "cuda" and LLM_QUANTIZATION == "8bit":
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
         
-        if device == "cpu":
-            model = model.to(device)
+            # Load model with memory optimizations
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                trust_remote_code=True,
+                torch_dtype=dtype,
+                device_map="auto" if device == "cuda" else None,
+                quantization_config=quantization_config,
+                cache_dir="/root/.cache/huggingface",
+                low_cpu_mem_usage=True,
+                use_safetensors=True
+            )
         
-        # Create pipeline
-        pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            device=device,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32
-        )
+            if device == "cpu":
+                model = model.to(device)
+            
+            # Sampling settings shared by every request; only max_new_tokens and
+            # temperature are passed per call
+            generation_config = copy.deepcopy(model.generation_config)
+            generation_config.do_sample = True
+            generation_config.pad_token_id = tokenizer.eos_token_id
+            generation_config.eos_token_id = tokenizer.eos_token_id
+        
+            # Static KV cache (passed to generate as past_key_values) + compiled decode
+            # step: no per-step cache reallocation during decode (CUDA graphs, so GPU only).
+            # bitsandbytes kernels don't trace under torch.compile, and an eager decode
+            # over the padded static buffer is slower than the dynamic cache, so quantized
+            # models keep the dynamic cache (and prefix reuse)
+            if (
+                device == "cuda"
+                and quantization_config is None
+                and getattr(model, "_supports_static_cache", False)
+            ):
+                static_cache = StaticCache(
+                    config=model.config,
+                    batch_size=1,
+                    max_cache_len=MAX_CACHE_LEN,
+                    device=model.device,
+                    dtype=model.dtype
+                )
+                model.forward = compile_decode_step(model.forward)
+                
+                # Warm up so the single decode graph isn't compiled by the first user
+                logger.info("Compiling model with a warm-up generation...")
+                warmup_ids = tokenizer.apply_chat_template(
+                    [{"role": "user", "content": "Hello"}], tokenize=True, add_generation_prompt=True
+                )
+                await run_on_gpu(generate_text, warmup_ids, max_new_tokens=8, temperature=0.7)
+            
+            # The static cache is the KV buffer itself, so prefix reuse only applies to dynamic caches
+            if static_cache is None and PREFIX_CACHE_SIZE > 0:
+                prefix_cache = PrefixCache(PREFIX_CACHE_SIZE)
         
         logger.info("Model loaded successfully!")
         
@@ -80,6 +196,7 @@ class ChatRequest(BaseModel):
     temperature: float = 0.7
     max_tokens: int = 1000
     model: str = "deepseek-coder"
+    stream: bool = False
 
 class ChatResponse(BaseModel):
     choices: List[Dict]
@@ -89,14 +206,14 @@ class ChatResponse(BaseModel):
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "model_loaded": model is not None}
+    return {"status": "healthy", "model_loaded": model is not None or engine is not None}
 
 @app.post("/v1/chat/completions", response_model=ChatResponse)
 async def chat_completions(request: ChatRequest):
     """OpenAI-compatible chat completions endpoint"""
-    global pipe, tokenizer
+    global model, tokenizer, engine
     
-    if not pipe or not tokenizer:
+    if not tokenizer or (not engine and not model):
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
@@ -104,45 +221,71 @@ async def chat_completions(request: ChatRequest):
         logger.info(f"Received chat request with {len(request.messages)} messages")
         logger.info(f"Request parameters: temperature={request.temperature}, max_tokens={request.max_tokens}")
         
-        # Convert messages to prompt format
-        prompt = format_messages_to_prompt(request.messages)
-        logger.info(f"Generated prompt: {prompt[:200]}...")  # Log first 200 chars
+        # Render the conversation with the chat template
+        messages = [message.model_dump() for message in request.messages]
+        prompts = [tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Generated prompt: {prompts[0][:200]}...")  # Log first 200 chars
         
-        # Generate response
-        logger.info("Generating response...")
-        response = pipe(
-            prompt,
-            max_new_tokens=request.max_tokens,
-            temperature=request.temperature,
-            do_sample=True,
-            pad_token_id=tokenizer.eos_token_id,
-            eos_token_id=tokenizer.eos_token_id,
-            return_full_text=False
-        )
+        # System prompt + history, whose KV cache can be reused across requests
+        # (only with the prefix cache; vLLM does its own prefix caching)
+        if prefix_cache is not None and len(messages) > 1:
+            prompts.append(tokenizer.apply_chat_template(messages[:-1], tokenize=False, add_generation_prompt=False))
         
-        # Extract generated text
-        generated_text = response[0]["generated_text"]
-        logger.info(f"Raw generated text: '{generated_text}'")
+        # Tokenize prompt and prefix in a single batched call (the template adds special tokens)
+        encoded = tokenizer(prompts, add_special_tokens=False).input_ids
+        prompt_ids = encoded[0]
+        prefix_ids = encoded[1] if len(encoded) > 1 else None
         
-        # Clean up the response (remove any remaining prompt)
-        if prompt in generated_text:
-            generated_text = generated_text.replace(prompt, "").strip()
-            logger.info(f"Cleaned text after prompt removal: '{generated_text}'")
+        # Stream tokens as server-sent events
+        if request.stream:
+            if engine is not None:
+                events = stream_text_vllm(prompt_ids, max_new_tokens=request.max_tokens, temperature=request.temperature)
+            else:
+                events = stream_text(
+                    prompt_ids,
+                    max_new_tokens=request.max_tokens,
+                    temperature=request.temperature,
+                    prefix_ids=prefix_ids
+                )
+            return StreamingResponse(events, media_type="text/event-stream")
         
-        # Additional cleanup for common issues
-        generated_text = generated_text.strip()
+        # Generate response
+        logger.info("Generating response...")
+        if engine is not None:
+            generated_text, usage = await generate_text_vllm(
+                prompt_ids,
+                max_new_tokens=request.max_tokens,
+                temperature=request.temperature
+            )
+        else:
+            # Generate on the GPU thread so the event loop keeps serving other requests
+            async with gpu_sem:
+                generated_text, usage = await run_on_gpu(
+                    generate_text,
+                    prompt_ids,
+                    max_new_tokens=request.max_tokens,
+                    temperature=request.temperature,
+                    prefix_ids=prefix_ids
+                )
+            
+            # Only the new tokens are decoded, so the prompt is never part of the text
+            generated_text = generated_text.strip()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Raw generated text: '{generated_text}'")
         
-        # Validate response quality
-        if not generated_text or len(generated_text.strip()) < 2:
-            logger.warning(f"Generated empty or very short response: '{generated_text}'")
-            generated_text = "I apologize, but I couldn't generate a proper response. Please try again with a different question."
+            # Validate response quality
+            if not generated_text or len(generated_text.strip()) < 2:
+                logger.warning(f"Generated empty or very short response: '{generated_text}'")
+                generated_text = "I apologize, but I couldn't generate a proper response. Please try again with a different question."
         
-        # Check for common problematic responses
-        if generated_text in [".", "!", "?", "...", "ok", "yes", "no"]:
-            logger.warning(f"Generated minimal response: '{generated_text}' - replacing with more helpful message")
-            generated_text = "I understand your question, but I need more context to provide a helpful answer. Could you please provide more details?"
+            # Check for common problematic responses
+            if generated_text in [".", "!", "?", "...", "ok", "yes", "no"]:
+                logger.warning(f"Generated minimal response: '{generated_text}' - replacing with more helpful message")
+                generated_text = "I understand your question, but I need more context to provide a helpful answer. Could you please provide more details?"
         
-        logger.info(f"Final response: '{generated_text}'")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Final response: '{generated_text}'")
         
         # Format response in OpenAI style
         return ChatResponse(
@@ -154,58 +297,281 @@ async def chat_completions(request: ChatRequest):
                 "finish_reason": "stop",
                 "index": 0
             }],
-            usage={
-                "prompt_tokens": len(tokenizer.encode(prompt)),
-                "completion_tokens": len(tokenizer.encode(generated_text)),
-                "total_tokens": len(tokenizer.encode(prompt)) + len(tokenizer.encode(generated_text))
-            }
+            usage=usage
         )
         
     except Exception as e:
         logger.error(f"Error generating response: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-def format_messages_to_prompt(messages: List[ChatMessage]) -> str:
-    """Convert chat messages to appropriate prompt format"""
-    prompt = ""
-    
-    # Get the model name to determine format
-    model_name = os.getenv("MODEL_NAME", "microsoft/DialoGPT-medium")
-    
-    if "deepseek" in model_name.lower():
-        # DeepSeek format
-        for message in messages:
-            if message.role == "system":
-                prompt += f"<|im_start|>system\n{message.content}<|im_end|>\n"
-            elif message.role == "user":
-                prompt += f"<|im_start|>user\n{message.content}<|im_end|>\n"
-            elif message.role == "assistant":
-                prompt += f"<|im_start|>assistant\n{message.content}<|im_end|>\n"
-        
-        # Add assistant start token for generation
-        prompt += "<|im_start|>assistant\n"
-    elif "distilgpt2" in model_name.lower():
-        # DistilGPT-2 format (simple continuation)
-        for message in messages:
-            if message.role == "user":
-                prompt += f"User: {message.content}\n"
-            elif message.role == "assistant":
-                prompt += f"Assistant: {message.content}\n"
-        
-        # Add assistant start for generation
-        prompt += "Assistant: "
-    else:
-        # DialoGPT format (simpler)
-        for message in messages:
-            if message.role == "user":
-                prompt += f"Human: {message.content}\n"
-            elif message.role == "assistant":
-                prompt += f"AI: {message.content}\n"
-        
-        # Add AI start for generation
-        prompt += "AI: "
-    
-    return prompt
+class PrefixCache:
+    """LRU of prefilled KV caches keyed by a hash of the prefix token ids"""
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = Lock()
+    
+    @staticmethod
+    def key(prefix_ids: List[int]) -> str:
+        return hashlib.sha1(torch.tensor(prefix_ids, dtype=torch.int64).numpy().tobytes()).hexdigest()
+    
+    def get(self, prefix_ids: List[int]):
+        key = self.key(prefix_ids)
+        with self.lock:
+            past_key_values = self.entries.get(key)
+            if past_key_values is not None:
+                self.entries.move_to_end(key)
+            return past_key_values
+    
+    def put(self, prefix_ids: List[int], past_key_values):
+        with self.lock:
+            self.entries[self.key(prefix_ids)] = past_key_values
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+def get_prefix_past(prefix_ids: List[int], prompt_ids: List[int]):
+    """Return the KV cache for the prompt prefix, prefilling and caching it on a miss"""
+    prefix_len = len(prefix_ids)
+    
+    # Only usable when the full prompt renders to the same ids over the prefix
+    if prefix_len == 0 or prefix_len >= len(prompt_ids) or prompt_ids[:prefix_len] != prefix_ids:
+        return None
+    
+    past_key_values = prefix_cache.get(prefix_ids)
+    if past_key_values is None:
+        with torch.no_grad():
+            input_ids = torch.tensor([prefix_ids], device=model.device)
+            past_key_values = model(input_ids=input_ids, use_cache=True).past_key_values
+        prefix_cache.put(prefix_ids, past_key_values)
+    
+    # Cache objects are extended in place by generate; legacy tuples are not
+    return copy.deepcopy(past_key_values) if isinstance(past_key_values, Cache) else past_key_values
+
+def build_generate_kwargs(
+    prompt_ids: List[int],
+    max_new_tokens: int,
+    temperature: float,
+    prefix_ids: Optional[List[int]] = None
+) -> Tuple[Dict, int]:
+    """Build the model.generate arguments for the prompt ids; returns them with the prompt length"""
+    input_ids = torch.tensor([prompt_ids], device=model.device)
+    prompt_len = input_ids.shape[1]
+    
+    generate_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        generation_config=generation_config,
+        max_new_tokens=max_new_tokens,
+        temperature=temperature
+    )
+    if static_cache is not None:
+        # The cache is allocated once; keep prompt + completion inside it
+        generate_kwargs["past_key_values"] = static_cache
+        generate_kwargs["max_new_tokens"] = min(max_new_tokens, MAX_CACHE_LEN - prompt_len)
+        if generate_kwargs["max_new_tokens"] <= 0:
+            raise ValueError(f"Prompt is too long ({prompt_len} tokens, limit {MAX_CACHE_LEN})")
+    elif prefix_cache is not None and prefix_ids:
+        # generate() only prefills the tokens after the cached prefix
+        past_key_values = get_prefix_past(prefix_ids, prompt_ids)
+        if past_key_values is not None:
+            generate_kwargs["past_key_values"] = past_key_values
+    
+    return generate_kwargs, prompt_len
+
+def compile_decode_step(forward):
+    """Compile only the one-token decode forward; prefill stays eager.
+    
+    Prompt lengths vary per request, so compiling the prefill with dynamic=False
+    would recompile for every new length until the recompile limit is hit and
+    torch falls back to eager. Decode always has the same shapes against the
+    static cache, so it compiles to one CUDA graph.
+    """
+    compiled_forward = torch.compile(forward, mode="reduce-overhead", dynamic=False)
+    
+    # Keep forward's signature: generate inspects it (e.g. for num_logits_to_keep)
+    @functools.wraps(forward)
+    def decode_or_prefill(*args, **kwargs):
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is not None and input_ids.shape[1] == 1:
+            return compiled_forward(*args, **kwargs)
+        return forward(*args, **kwargs)
+    
+    return decode_or_prefill
+
+def run_generate(**generate_kwargs):
+    """model.generate on a clean static cache; callers hold gpu_sem"""
+    if static_cache is not None:
+        static_cache.reset()
+    return model.generate(**generate_kwargs)
+
+def generate_text(
+    prompt_ids: List[int],
+    max_new_tokens: int,
+    temperature: float,
+    prefix_ids: Optional[List[int]] = None
+) -> Tuple[str, Dict]:
+    """Run model.generate on the prompt; returns the newly generated text and token usage"""
+    generate_kwargs, prompt_len = build_generate_kwargs(prompt_ids, max_new_tokens, temperature, prefix_ids)
+    output_ids = run_generate(**generate_kwargs)
+    
+    # Token counts come straight from the generated ids, no re-tokenization
+    completion_tokens = output_ids.shape[1] - prompt_len
+    
+    return tokenizer.decode(output_ids[0, prompt_len:], skip_special_tokens=True), {
+        "prompt_tokens": prompt_len,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_len + completion_tokens
+    }
+
+class CancelledCriteria(StoppingCriteria):
+    """Stop generation once the event is set"""
+    
+    def __init__(self, event: Event):
+        self.event = event
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+async def stream_text(
+    prompt_ids: List[int],
+    max_new_tokens: int,
+    temperature: float,
+    prefix_ids: Optional[List[int]] = None
+) -> AsyncIterator[str]:
+    """Yield SSE chunks as model.generate produces tokens on the GPU thread"""
+    async with gpu_sem:
+        try:
+            generate_kwargs, _ = await run_on_gpu(
+                build_generate_kwargs, prompt_ids, max_new_tokens, temperature, prefix_ids
+            )
+        except Exception as e:
+            logger.error(f"Error streaming response: {e}")
+            yield f"data: {json.dumps({'error': {'message': str(e)}})}\n\n"
+            return
+        
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        cancelled = Event()
+        stopping_criteria = StoppingCriteriaList([CancelledCriteria(cancelled)])
+        
+        # Set by run() before it ends the streamer, so it is visible once the loop exits
+        error = None
+        
+        def run():
+            nonlocal error
+            try:
+                run_generate(**generate_kwargs, streamer=streamer, stopping_criteria=stopping_criteria)
+            except Exception as e:
+                logger.error(f"Error streaming response: {e}")
+                error = e
+                streamer.end()
+        
+        generation = gpu_executor.submit(run)
+        try:
+            # Pull tokens off the streamer without blocking the event loop
+            while True:
+                text = await asyncio.to_thread(next, streamer, None)
+                if text is None:
+                    break
+                if text:
+                    yield sse_chunk(content=text)
+            if error is not None:
+                yield f"data: {json.dumps({'error': {'message': str(error)}})}\n\n"
+                return
+            yield sse_chunk(finish_reason="stop")
+            yield "data: [DONE]\n\n"
+        finally:
+            # Stop generating (and free the KV cache) when the client goes away, and
+            # hold the semaphore until the model is idle again. Shielded: on disconnect
+            # this scope is already cancelled and an unshielded await would return
+            # immediately, releasing gpu_sem while generate is still running
+            cancelled.set()
+            with anyio.CancelScope(shield=True):
+                await asyncio.wrap_future(generation)
+
+async def generate_text_vllm(prompt_ids: List[int], max_new_tokens: int, temperature: float) -> Tuple[str, Dict]:
+    """Generate with the vLLM engine; returns the completion text and token usage"""
+    from vllm import SamplingParams
+    
+    sampling_params = SamplingParams(temperature=temperature, max_tokens=max_new_tokens)
+    final_output = None
+    async for output in engine.generate({"prompt_token_ids": prompt_ids}, sampling_params, request_id=uuid4().hex):
+        final_output = output
+    
+    completion = final_output.outputs[0]
+    prompt_tokens = len(final_output.prompt_token_ids)
+    completion_tokens = len(completion.token_ids)
+    
+    return completion.text.strip(), {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+async def stream_text_vllm(prompt_ids: List[int], max_new_tokens: int, temperature: float) -> AsyncIterator[str]:
+    """Yield SSE chunks from the vLLM engine (the request is aborted if the client disconnects)"""
+    from vllm import SamplingParams
+    
+    sampling_params = SamplingParams(temperature=temperature, max_tokens=max_new_tokens)
+    sent = 0
+    async for output in engine.generate({"prompt_token_ids": prompt_ids}, sampling_params, request_id=uuid4().hex):
+        # vLLM returns the cumulative text; only send what is new
+        text = output.outputs[0].text
+        if len(text) > sent:
+            yield sse_chunk(content=text[sent:])
+            sent = len(text)
+    
+    yield sse_chunk(finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+def sse_chunk(content: Optional[str] = None, finish_reason: Optional[str] = None) -> str:
+    """Format an OpenAI-style chat.completion.chunk server-sent event"""
+    chunk = {
+        "object": "chat.completion.chunk",
+        "choices": [{
+            "index": 0,
+            "delta": {"content": content} if content is not None else {},
+            "finish_reason": finish_reason
+        }]
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+# Chat templates for models whose tokenizer doesn't ship one
+CHATML_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{{ '<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>\n' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
+)
+
+# DistilGPT-2 format (simple continuation)
+DISTILGPT2_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{% if message['role'] == 'user' %}{{ 'User: ' + message['content'] + '\n' }}"
+    "{% elif message['role'] == 'assistant' %}{{ 'Assistant: ' + message['content'] + '\n' }}"
+    "{% endif %}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ 'Assistant: ' }}{% endif %}"
+)
+
+# DialoGPT format (simpler)
+DIALOGPT_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{% if message['role'] == 'user' %}{{ 'Human: ' + message['content'] + '\n' }}"
+    "{% elif message['role'] == 'assistant' %}{{ 'AI: ' + message['content'] + '\n' }}"
+    "{% endif %}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ 'AI: ' }}{% endif %}"
+)
+
+def select_chat_template(model_name: str) -> str:
+    """Pick the fallback chat template for the model once, at startup"""
+    model_name = model_name.lower()
+    if "deepseek" in model_name:
+        return CHATML_CHAT_TEMPLATE
+    if "distilgpt2" in model_name:
+        return DISTILGPT2_CHAT_TEMPLATE
+    return DIALOGPT_CHAT_TEMPLATE
 
 @app.get("/models")
 async def list_models():